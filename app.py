@@ -1,102 +1,441 @@
 # app.py
-from flask import Flask, jsonify, abort, send_file
+from flask import Flask, Response, abort, send_file, request, stream_template
+from flask_compress import Compress
+from markupsafe import escape
+from werkzeug.routing import BaseConverter
+import hashlib
 import os
-from sqlalchemy import create_engine, text
-from sqlalchemy.engine import URL
+import re
+import threading
+from decimal import Decimal
+
+import orjson
+from cachetools import TTLCache, cached
+from cachetools.keys import hashkey
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.engine import URL, make_url
 from sqlalchemy.exc import OperationalError
+from sqlalchemy.pool import NullPool
 
 _engine = None
+_engine_lock = threading.Lock()
+
+# Statements are built once at import and reused, so SQLAlchemy's compiled
+# cache is hit on every request instead of re-parsing fresh text() objects.
+#
+# The JSON endpoints have PostgreSQL build the studies array itself (cast to
+# text so psycopg2 hands it back unparsed), skipping Python row handling.
+#
+# Term lookups read the pre-aggregated ns.term_study_weights view, falling
+# back to aggregating ns.annotations_terms on databases that predate it.
+_TERMS_SQL = """
+    SELECT coalesce(json_agg(t ORDER BY t.avg_weight DESC), '[]')::text AS studies,
+           count(*) AS n
+    FROM (
+        {source}
+        ORDER BY avg_weight DESC
+        LIMIT 100
+    ) t;
+"""
+_TERMS_VIEW_SOURCE = """
+        SELECT study_id, term, avg_weight
+        FROM ns.term_study_weights
+        WHERE {where}"""
+_TERMS_TABLE_SOURCE = """
+        SELECT study_id, term, AVG(weight) AS avg_weight
+        FROM ns.annotations_terms
+        WHERE {where}
+        GROUP BY study_id, term"""
+# (use_view, exact) -> statement
+_Q_TERMS = {
+    (use_view, exact): text(_TERMS_SQL.format(
+        source=(_TERMS_VIEW_SOURCE if use_view else _TERMS_TABLE_SOURCE).format(
+            where="term = :term" if exact else "term ILIKE :term",
+        ),
+    ))
+    for use_view in (True, False)
+    for exact in (True, False)
+}
+_Q_HAS_TERM_WEIGHTS = text("SELECT to_regclass('ns.term_study_weights') IS NOT NULL;")
+
+# The query point takes the column's SRID (0 after migration, 4326 on a
+# database loaded by an older create_db.py) so both keep working; the
+# distance maths is planar either way.
+_Q_LOCATIONS = text("""
+    WITH p AS (SELECT ST_SetSRID(ST_MakePoint(:x, :y, :z), Find_SRID('ns', 'coordinates', 'geom')) AS g),
+    t AS (
+        SELECT DISTINCT c.study_id,
+               ST_X(c.geom) as x,
+               ST_Y(c.geom) as y,
+               ST_Z(c.geom) as z,
+               ST_3DDistance(c.geom, p.g) as distance
+        FROM ns.coordinates c, p
+        WHERE ST_3DDWithin(c.geom, p.g, 5)
+        ORDER BY distance
+        LIMIT 100
+    )
+    SELECT coalesce(json_agg(t ORDER BY t.distance), '[]')::text AS studies,
+           count(*) AS n
+    FROM t;
+""")
+
+_Q_DISSOCIATE_TERMS = text("""
+    SELECT DISTINCT a.study_id, a.term, a.weight
+    FROM ns.annotations_terms a
+    LEFT JOIN ns.annotations_terms b
+           ON b.study_id = a.study_id
+          AND b.term ILIKE :term_b
+    WHERE a.term ILIKE :term_a
+      AND b.study_id IS NULL
+    ORDER BY a.weight DESC
+    LIMIT 100;
+""")
+
+_Q_DISSOCIATE_LOCATIONS = text("""
+    WITH srid AS (SELECT Find_SRID('ns', 'coordinates', 'geom') AS s),
+         p1 AS (SELECT ST_SetSRID(ST_MakePoint(:x1, :y1, :z1), srid.s) AS g FROM srid),
+         p2 AS (SELECT ST_SetSRID(ST_MakePoint(:x2, :y2, :z2), srid.s) AS g FROM srid)
+    SELECT DISTINCT c1.study_id,
+           ST_X(c1.geom) as x,
+           ST_Y(c1.geom) as y,
+           ST_Z(c1.geom) as z,
+           ST_3DDistance(c1.geom, p1.g) as dist_a
+    FROM ns.coordinates c1
+    CROSS JOIN p1
+    CROSS JOIN p2
+    LEFT JOIN ns.coordinates c2
+           ON c2.study_id = c1.study_id
+          AND ST_3DDWithin(c2.geom, p2.g, 5)
+    WHERE ST_3DDWithin(c1.geom, p1.g, 5)
+      AND c2.study_id IS NULL
+    ORDER BY dist_a
+    LIMIT 100;
+""")
+
+# Planner row estimates (kept current by ANALYZE in create_db.py) instead of
+# full-table COUNT(*) scans. A never-analyzed table reports -1 (PG 14+) or 0
+# (older), so both fall back to an exact count -- cheap when truly empty.
+_Q_COUNT_ESTIMATES = text("""
+    SELECT c.relname, c.reltuples::bigint AS n
+    FROM pg_class c
+    WHERE c.oid IN ('ns.coordinates'::regclass, 'ns.metadata'::regclass, 'ns.annotations_terms'::regclass);
+""")
+_Q_COUNT = {
+    "coordinates": text("SELECT COUNT(*) FROM ns.coordinates"),
+    "metadata": text("SELECT COUNT(*) FROM ns.metadata"),
+    "annotations_terms": text("SELECT COUNT(*) FROM ns.annotations_terms"),
+}
+_Q_SAMPLE_COORDINATES = text(
+    "SELECT study_id, ST_X(geom) AS x, ST_Y(geom) AS y, ST_Z(geom) AS z FROM ns.coordinates LIMIT 3"
+)
+_Q_SAMPLE_METADATA = text("SELECT * FROM ns.metadata LIMIT 3")
+_Q_SAMPLE_ANNOTATIONS = text(
+    "SELECT study_id, contrast_id, term, weight FROM ns.annotations_terms LIMIT 3"
+)
+
+# Read-only query endpoints whose output depends only on the URL
+_CACHEABLE_ENDPOINTS = frozenset({
+    "terms_studies", "locations_studies", "dissociate_terms", "dissociate_locations",
+})
+
+def _query_etag():
+    """ETag derived from the request URL, so a revalidation never touches the DB.
+
+    Bump DATA_VERSION after reloading the database to invalidate old tags.
+    """
+    key = f"{os.getenv('DATA_VERSION', '')}|{request.full_path}"
+    return hashlib.md5(key.encode()).hexdigest()
+
+def _json_default(obj):
+    # orjson covers datetime/UUID natively; NUMERIC columns come back as Decimal
+    if isinstance(obj, Decimal):
+        return float(obj)
+    raise TypeError(f"Type is not JSON serializable: {type(obj).__name__}")
+
+def ojsonify(obj, status=200):
+    """Like flask.jsonify, but serialized with orjson."""
+    return Response(orjson.dumps(obj, default=_json_default), status=status, mimetype="application/json")
+
+def _studies_body(head, res):
+    """Splice a DB-built ``studies`` JSON array into the response envelope.
+
+    ``res`` is a one-row (studies, n) result from one of the json_agg queries.
+    """
+    studies_json, n = res.one()
+    # Serialize the envelope, then reopen its closing brace for the raw array
+    return orjson.dumps({**head, "count": n})[:-1] + b',"studies":' + studies_json.encode() + b"}"
+
+def _rows_as_dicts(res):
+    """Materialize a result as a list of plain dicts, resolving keys once."""
+    keys = tuple(res.keys())
+    return [dict(zip(keys, row)) for row in res.fetchall()]
+
+_COORDS_RE = re.compile(r"^(-?\d+(?:\.\d+)?)_(-?\d+(?:\.\d+)?)_(-?\d+(?:\.\d+)?)$")
+
+class CoordsConverter(BaseConverter):
+    """Parse an ``x_y_z`` path segment into a float triple during routing.
+
+    Malformed segments convert to None instead of failing the match, so the
+    view can still answer 400 rather than 404.
+    """
+
+    def to_python(self, value):
+        m = _COORDS_RE.match(value)
+        return tuple(map(float, m.groups())) if m else None
+
+    def to_url(self, value):
+        return "_".join(str(v) for v in value)
 
 def get_engine():
     global _engine
     if _engine is not None:
         return _engine
+    # gthread workers: several threads can race here on a fresh process
+    with _engine_lock:
+        if _engine is None:
+            _engine = _build_engine()
+    return _engine
+
+def _build_engine():
     db_url = os.getenv("DB_URL")
     if not db_url:
         raise RuntimeError("Missing DB_URL (or DATABASE_URL) environment variable.")
     # Normalize old 'postgres://' scheme to 'postgresql://'
     if db_url.startswith("postgres://"):
         db_url = "postgresql://" + db_url[len("postgres://"):]
-    _engine = create_engine(
+    # JIT only adds compile time to these short queries, and the timeout keeps
+    # a pathological query from pinning a pool slot.
+    statement_timeout = int(os.getenv("DB_STATEMENT_TIMEOUT_MS", "5000"))
+    session_settings = {"search_path": "ns,public", "jit": "off", "statement_timeout": statement_timeout}
+    use_pgbouncer = os.getenv("DB_POOL", "queue").lower() == "null"
+    engine_kwargs = {"future": True}
+    if not use_pgbouncer:
+        # Direct connections: applied once per physical connection at handshake
+        engine_kwargs["connect_args"] = {
+            "options": " ".join(f"-c{k}={v}" for k, v in session_settings.items()),
+        }
+    if make_url(db_url).get_driver_name() == "psycopg2":
+        # INSERTs already use insertmanyvalues in 1000-row pages on SQLAlchemy
+        # 2.x (stated here only to make it explicit). values_plus_batch adds
+        # execute_batch for executemany() UPDATE/DELETE, 500 statements a page.
+        engine_kwargs.update(
+            executemany_mode="values_plus_batch",
+            insertmanyvalues_page_size=1000,
+            executemany_batch_page_size=500,
+        )
+    if use_pgbouncer:
+        # Behind PgBouncer (transaction mode) let the bouncer do the pooling.
+        # It rejects (or drops) the libpq "options" startup parameter, so set
+        # the session settings per transaction instead.
+        engine = create_engine(db_url, poolclass=NullPool, **engine_kwargs)
+        set_local = " ".join(f"SET LOCAL {k} = {v};" for k, v in session_settings.items())
+
+        @event.listens_for(engine, "begin")
+        def _apply_session_settings(conn):
+            conn.exec_driver_sql(set_local)
+
+        return engine
+    return create_engine(
         db_url,
+        pool_size=int(os.getenv("DB_POOL_SIZE", "20")),
+        max_overflow=int(os.getenv("DB_MAX_OVERFLOW", "10")),
+        pool_timeout=5,
+        pool_recycle=1800,
         pool_pre_ping=True,
+        **engine_kwargs,
     )
-    return _engine
+
+# Per-process memo of serialized JSON bodies for the hot query endpoints, so
+# repeat hits within the TTL skip the database. Failures raise and are not cached.
+_response_cache = TTLCache(
+    maxsize=int(os.getenv("RESPONSE_CACHE_SIZE", "4096")),
+    ttl=int(os.getenv("RESPONSE_CACHE_TTL", "300")),
+)
+_response_cache_lock = threading.Lock()
+
+# Only a positive answer is remembered, so a worker picks up the view as
+# soon as the migration creates it
+_has_term_weights = False
+
+def _term_weights_available(conn):
+    global _has_term_weights
+    if not _has_term_weights:
+        _has_term_weights = conn.execute(_Q_HAS_TERM_WEIGHTS).scalar()
+    return _has_term_weights
+
+@cached(_response_cache, key=lambda term, exact: hashkey("terms", term, exact), lock=_response_cache_lock)
+def _studies_by_term_body(term, exact):
+    # Terms are stored lowercased with spaces; URLs carry underscores
+    bound = term.replace("_", " ").lower() if exact else f"%{term}%"
+    with get_engine().begin() as conn:
+        stmt = _Q_TERMS[(_term_weights_available(conn), exact)]
+        return _studies_body({"term": term}, conn.execute(stmt, {"term": bound}))
+
+@cached(_response_cache, key=lambda x, y, z: hashkey("locations", x, y, z), lock=_response_cache_lock)
+def _studies_by_coordinates_body(x, y, z):
+    with get_engine().begin() as conn:
+        # Find studies within 5mm radius of the coordinate
+        return _studies_body(
+            {"coordinates": {"x": x, "y": y, "z": z}},
+            conn.execute(_Q_LOCATIONS, {"x": x, "y": y, "z": z}),
+        )
+
+def ensure_indexes(eng):
+    """Create the indexes and views the query endpoints rely on, if missing.
+
+    Names match the ones built by create_db.py, so this is a no-op on a
+    freshly loaded database. Databases loaded by an older create_db.py are
+    migrated first: coordinates go from SRID 4326 to Cartesian SRID 0, and
+    terms lose the "terms_<source>__" column prefix the old loader kept.
+
+    Run once per deploy via ``flask --app app ensure-indexes``, never from
+    worker startup: the builds take minutes and the ALTER locks the table.
+    """
+    with eng.begin() as conn:
+        # Serialize concurrent runs; IF NOT EXISTS is not race-safe in DDL
+        conn.execute(text("SELECT pg_advisory_xact_lock(hashtext('ns.ensure_indexes'));"))
+        # Index builds outlast the per-request statement timeout
+        conn.execute(text("SET LOCAL statement_timeout = 0;"))
+        conn.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm;"))
+        srid = conn.execute(text("SELECT Find_SRID('ns', 'coordinates', 'geom');")).scalar()
+        if srid != 0:
+            # MNI coordinates are millimetres in 3D, not lon/lat degrees
+            conn.execute(text("DROP INDEX IF EXISTS ns.idx_coordinates_geom_gist;"))
+            conn.execute(text("ALTER TABLE ns.coordinates ALTER COLUMN geom TYPE geometry(POINTZ, 0) USING ST_SetSRID(geom, 0);"))
+        # N-D GiST on geom lets ST_3DDWithin use the 3D bounding-box pre-filter
+        conn.execute(text("CREATE INDEX IF NOT EXISTS idx_coordinates_geom_nd ON ns.coordinates USING GIST (geom gist_geometry_ops_nd);"))
+        # study_id lookup for the anti-join in dissociate_by_locations
+        conn.execute(text("CREATE INDEX IF NOT EXISTS idx_coordinates_study ON ns.coordinates (study_id);"))
+        conn.execute(text("CREATE INDEX IF NOT EXISTS idx_annotations_terms_term_trgm ON ns.annotations_terms USING GIN (term gin_trgm_ops);"))
+        # Same prefix stripping as create_db.py: split on the first "__"
+        stripped = conn.execute(text(r"""
+            UPDATE ns.annotations_terms
+            SET term = lower(btrim(substr(term, strpos(term, '__') + 2)))
+            WHERE term LIKE 'terms\_%' AND strpos(term, '__') > 0;
+        """)).rowcount
+        if stripped:
+            # Rebuilt below from the corrected terms
+            conn.execute(text("DROP MATERIALIZED VIEW IF EXISTS ns.term_study_weights;"))
+            conn.execute(text("ANALYZE ns.annotations_terms;"))
+        conn.execute(text("""
+            CREATE MATERIALIZED VIEW IF NOT EXISTS ns.term_study_weights AS
+            SELECT study_id, term, AVG(weight) AS avg_weight
+            FROM ns.annotations_terms
+            GROUP BY study_id, term;
+        """))
+        conn.execute(text("CREATE UNIQUE INDEX IF NOT EXISTS ux_term_study_weights ON ns.term_study_weights (study_id, term);"))
+        conn.execute(text("CREATE INDEX IF NOT EXISTS idx_term_study_weights_term_trgm ON ns.term_study_weights USING GIN (term gin_trgm_ops);"))
+        # Built by earlier versions; never shown to pay off, so not kept
+        conn.execute(text("DROP INDEX IF EXISTS ns.idx_term_study_weights_term_weight;"))
 
 def create_app():
     app = Flask(__name__)
+    app.url_map.converters["coords"] = CoordsConverter
+
+    # Brotli/gzip for the JSON and HTML payloads. Set COMPRESS_RESPONSES=0 when
+    # a front proxy already compresses, to keep that work off the workers.
+    # Registered before the cache hook so it sees the final ETag.
+    app.config.update(
+        COMPRESS_ALGORITHM=["br", "gzip"],
+        COMPRESS_MIN_SIZE=500,
+        # Keep stream_template responses streaming instead of buffering them
+        COMPRESS_STREAMS=False,
+        COMPRESS_REGISTER=os.getenv("COMPRESS_RESPONSES", "1").lower() in ("1", "true", "yes"),
+    )
+    Compress(app)
+
+    @app.cli.command("ensure-indexes")
+    def ensure_indexes_command():
+        """Create missing indexes/views and migrate coordinates to SRID 0."""
+        ensure_indexes(get_engine())
+        print("✅ indexes and views are up to date")
+
+    cache_max_age = int(os.getenv("CACHE_MAX_AGE", "3600"))
+    compress_algorithms = app.config["COMPRESS_ALGORITHM"] if app.config["COMPRESS_REGISTER"] else []
+
+    def _negotiated_encoding():
+        # Mirror Flask-Compress: the client's highest q wins, ties go to the
+        # COMPRESS_ALGORITHM order, q=0 means "not acceptable"
+        best, best_q = None, 0
+        for alg in compress_algorithms:
+            q = request.accept_encodings[alg]
+            if q > best_q:
+                best, best_q = alg, q
+        return best
+
+    def _set_cache_headers(resp, etag):
+        resp.set_etag(etag)
+        resp.cache_control.public = True
+        resp.cache_control.max_age = cache_max_age
+
+    @app.before_request
+    def _not_modified():
+        if request.endpoint not in _CACHEABLE_ENDPOINTS:
+            return None
+        etag = _query_etag()
+        # Flask-Compress suffixes the tag of a compressed 200 with its encoding
+        # ("<tag>:br"); the 304 must carry the validator that 200 would have
+        encoding = _negotiated_encoding()
+        candidates = [etag, f"{etag}:{encoding}"] if encoding else [etag]
+        matched = next((tag for tag in candidates if tag in request.if_none_match), None)
+        if matched is None:
+            return None
+        resp = app.response_class(status=304)
+        _set_cache_headers(resp, matched)
+        if compress_algorithms:
+            resp.vary.add("Accept-Encoding")
+        return resp
+
+    @app.after_request
+    def _add_cache_headers(resp):
+        if request.endpoint in _CACHEABLE_ENDPOINTS and resp.status_code == 200:
+            _set_cache_headers(resp, _query_etag())
+        return resp
 
     @app.get("/", endpoint="health")
     def health():
         return "<p>Server working!</p>"
 
+    # Let Apache/lighttpd (X-Sendfile) or nginx (X-Accel-Redirect) stream the
+    # static image so the worker is freed as soon as headers are written
+    app.config["USE_X_SENDFILE"] = os.getenv("USE_X_SENDFILE", "0").lower() in ("1", "true", "yes")
+    x_accel_prefix = os.getenv("X_ACCEL_PREFIX")
+
     @app.get("/img", endpoint="show_img")
     def show_img():
-        return send_file("amygdala.gif", mimetype="image/gif")
+        if x_accel_prefix:
+            resp = app.response_class(mimetype="image/gif")
+            resp.headers["X-Accel-Redirect"] = x_accel_prefix.rstrip("/") + "/amygdala.gif"
+        else:
+            resp = send_file("amygdala.gif", mimetype="image/gif", max_age=86400)
+        resp.cache_control.public = True
+        resp.cache_control.max_age = 86400
+        resp.cache_control.immutable = True
+        return resp
 
     @app.get("/terms/<term>/studies", endpoint="terms_studies")
     def get_studies_by_term(term):
-        """Get studies that mention a specific term."""
-        eng = get_engine()
+        """Get studies that mention a specific term.
+
+        Pass ?exact=1 to match the term exactly instead of as a substring;
+        underscores and case are normalized
+        to the stored form, e.g. Posterior_Cingulate -> "posterior cingulate".
+        """
+        exact = request.args.get("exact", "0").lower() in ("1", "true", "yes")
         try:
-            with eng.begin() as conn:
-                conn.execute(text("SET search_path TO ns, public;"))
-                
-                # Query studies that mention this term
-                rows = conn.execute(text("""
-                    SELECT DISTINCT study_id, term, AVG(weight) as avg_weight
-                    FROM ns.annotations_terms
-                    WHERE term LIKE :term
-                    GROUP BY study_id, term
-                    ORDER BY avg_weight DESC
-                    LIMIT 100;
-                """), {"term": f"%{term}%"}).mappings().all()
-                
-                studies = [dict(r) for r in rows]
-                return jsonify({
-                    "term": term,
-                    "count": len(studies),
-                    "studies": studies
-                }), 200
-                
+            return Response(_studies_by_term_body(term, exact), mimetype="application/json")
         except Exception as e:
-            return jsonify({"error": str(e)}), 500
+            return ojsonify({"error": str(e)}, 500)
 
-    @app.get("/locations/<coords>/studies", endpoint="locations_studies")
+    @app.get("/locations/<coords:coords>/studies", endpoint="locations_studies")
     def get_studies_by_coordinates(coords):
         """Get studies at specific MNI coordinates."""
+        if coords is None:
+            return ojsonify({"error": "Invalid coordinates format. Use x_y_z"}, 400)
         try:
-            x, y, z = map(float, coords.split("_"))
-        except ValueError:
-            return jsonify({"error": "Invalid coordinates format. Use x_y_z"}), 400
-            
-        eng = get_engine()
-        try:
-            with eng.begin() as conn:
-                conn.execute(text("SET search_path TO ns, public;"))
-                
-                # Find studies within 5mm radius of the coordinate
-                rows = conn.execute(text("""
-                    SELECT DISTINCT study_id, 
-                           ST_X(geom) as x, 
-                           ST_Y(geom) as y, 
-                           ST_Z(geom) as z,
-                           ST_Distance(geom, ST_SetSRID(ST_MakePoint(:x, :y, :z), 4326)) as distance
-                    FROM ns.coordinates
-                    WHERE ST_DWithin(geom, ST_SetSRID(ST_MakePoint(:x, :y, :z), 4326), 5)
-                    ORDER BY distance
-                    LIMIT 100;
-                """), {"x": x, "y": y, "z": z}).mappings().all()
-                
-                studies = [dict(r) for r in rows]
-                return jsonify({
-                    "coordinates": {"x": x, "y": y, "z": z},
-                    "count": len(studies),
-                    "studies": studies
-                }), 200
-                
+            return Response(_studies_by_coordinates_body(*coords), mimetype="application/json")
         except Exception as e:
-            return jsonify({"error": str(e)}), 500
+            return ojsonify({"error": str(e)}, 500)
 
     @app.get("/dissociate/terms/<term_a>/<term_b>", endpoint="dissociate_terms")
     def dissociate_by_terms(term_a, term_b):
@@ -107,301 +446,42 @@ def create_app():
         eng = get_engine()
         try:
             with eng.begin() as conn:
-                conn.execute(text("SET search_path TO ns, public;"))
-                
                 # Studies with term_a but NOT term_b
-                rows = conn.execute(text("""
-                    SELECT DISTINCT a.study_id, a.term, a.weight
-                    FROM ns.annotations_terms a
-                    WHERE a.term LIKE :term_a
-                      AND NOT EXISTS (
-                          SELECT 1 FROM ns.annotations_terms b
-                          WHERE b.study_id = a.study_id
-                            AND b.term LIKE :term_b
-                      )
-                    ORDER BY a.weight DESC
-                    LIMIT 100;
-                """), {"term_a": f"%{term_a}%", "term_b": f"%{term_b}%"}).mappings().all()
-                
-                studies = [dict(r) for r in rows]
-                
-                # Generate HTML table
-                html = f"""
-                <!DOCTYPE html>
-                <html>
-                <head>
-                    <title>Functional Dissociation: {term_a} \\ {term_b}</title>
-                    <style>
-                        body {{
-                            font-family: 'Segoe UI', Tahoma, Geneva, Verdana, sans-serif;
-                            max-width: 1200px;
-                            margin: 40px auto;
-                            padding: 20px;
-                            background-color: #f5f5f5;
-                        }}
-                        .header {{
-                            background: linear-gradient(135deg, #667eea 0%, #764ba2 100%);
-                            color: white;
-                            padding: 30px;
-                            border-radius: 10px;
-                            margin-bottom: 30px;
-                            box-shadow: 0 4px 6px rgba(0,0,0,0.1);
-                        }}
-                        h1 {{
-                            margin: 0 0 10px 0;
-                            font-size: 28px;
-                        }}
-                        .info {{
-                            font-size: 16px;
-                            opacity: 0.9;
-                        }}
-                        table {{
-                            width: 100%;
-                            border-collapse: collapse;
-                            background-color: white;
-                            box-shadow: 0 2px 4px rgba(0,0,0,0.1);
-                            border-radius: 8px;
-                            overflow: hidden;
-                        }}
-                        th {{
-                            background-color: #667eea;
-                            color: white;
-                            padding: 15px;
-                            text-align: left;
-                            font-weight: 600;
-                        }}
-                        td {{
-                            padding: 12px 15px;
-                            border-bottom: 1px solid #e0e0e0;
-                        }}
-                        tr:hover {{
-                            background-color: #f8f9fa;
-                        }}
-                        tr:last-child td {{
-                            border-bottom: none;
-                        }}
-                        .count-badge {{
-                            display: inline-block;
-                            background-color: #764ba2;
-                            color: white;
-                            padding: 5px 15px;
-                            border-radius: 20px;
-                            font-size: 14px;
-                            margin-top: 10px;
-                        }}
-                        .weight {{
-                            font-weight: bold;
-                            color: #667eea;
-                        }}
-                    </style>
-                </head>
-                <body>
-                    <div class="header">
-                        <h1>🧠 Functional Dissociation by Terms</h1>
-                        <div class="info">
-                            <strong>Term A:</strong> {term_a}<br>
-                            <strong>Term B:</strong> {term_b}<br>
-                            <strong>Description:</strong> Studies mentioning '{term_a}' but NOT '{term_b}'
-                        </div>
-                        <div class="count-badge">Total Results: {len(studies)}</div>
-                    </div>
-                    <table>
-                        <thead>
-                            <tr>
-                                <th>#</th>
-                                <th>Study ID</th>
-                                <th>Term</th>
-                                <th>Weight</th>
-                            </tr>
-                        </thead>
-                        <tbody>
-                """
+                studies = _rows_as_dicts(conn.execute(_Q_DISSOCIATE_TERMS, {"term_a": f"%{term_a}%", "term_b": f"%{term_b}%"}))
                 
-                for idx, study in enumerate(studies, 1):
-                    html += f"""
-                            <tr>
-                                <td>{idx}</td>
-                                <td>{study['study_id']}</td>
-                                <td>{study['term']}</td>
-                                <td class="weight">{study['weight']:.6f}</td>
-                            </tr>
-                    """
-                
-                html += """
-                        </tbody>
-                    </table>
-                </body>
-                </html>
-                """
-                
-                return html, 200
+                return app.response_class(stream_template(
+                    "dissociate_terms.html", term_a=term_a, term_b=term_b, studies=studies,
+                ))
                 
         except Exception as e:
-            return f"<h1>Error</h1><p>{str(e)}</p>", 500
+            return f"<h1>Error</h1><p>{escape(str(e))}</p>", 500
 
-    @app.get("/dissociate/locations/<coords_a>/<coords_b>", endpoint="dissociate_locations")
+    @app.get("/dissociate/locations/<coords:coords_a>/<coords:coords_b>", endpoint="dissociate_locations")
     def dissociate_by_locations(coords_a, coords_b):
         """
         Functional dissociation by MNI coordinates.
         Returns studies at coords_a but NOT at coords_b.
         """
-        try:
-            x1, y1, z1 = map(float, coords_a.split("_"))
-            x2, y2, z2 = map(float, coords_b.split("_"))
-        except ValueError:
+        if coords_a is None or coords_b is None:
             return "<h1>Error</h1><p>Invalid coordinates format. Use x_y_z</p>", 400
+        x1, y1, z1 = coords_a
+        x2, y2, z2 = coords_b
             
         eng = get_engine()
         try:
             with eng.begin() as conn:
-                conn.execute(text("SET search_path TO ns, public;"))
-                
                 # Studies at coords_a (within 5mm) but NOT at coords_b (within 5mm)
-                rows = conn.execute(text("""
-                    SELECT DISTINCT c1.study_id,
-                           ST_X(c1.geom) as x,
-                           ST_Y(c1.geom) as y,
-                           ST_Z(c1.geom) as z,
-                           ST_Distance(c1.geom, ST_SetSRID(ST_MakePoint(:x1, :y1, :z1), 4326)) as dist_a
-                    FROM ns.coordinates c1
-                    WHERE ST_DWithin(c1.geom, ST_SetSRID(ST_MakePoint(:x1, :y1, :z1), 4326), 5)
-                      AND NOT EXISTS (
-                          SELECT 1 FROM ns.coordinates c2
-                          WHERE c2.study_id = c1.study_id
-                            AND ST_DWithin(c2.geom, ST_SetSRID(ST_MakePoint(:x2, :y2, :z2), 4326), 5)
-                      )
-                    ORDER BY dist_a
-                    LIMIT 100;
-                """), {"x1": x1, "y1": y1, "z1": z1, "x2": x2, "y2": y2, "z2": z2}).mappings().all()
-                
-                studies = [dict(r) for r in rows]
-                
-                # Generate HTML table
-                html = f"""
-                <!DOCTYPE html>
-                <html>
-                <head>
-                    <title>Functional Dissociation: [{x1}, {y1}, {z1}] \\ [{x2}, {y2}, {z2}]</title>
-                    <style>
-                        body {{
-                            font-family: 'Segoe UI', Tahoma, Geneva, Verdana, sans-serif;
-                            max-width: 1200px;
-                            margin: 40px auto;
-                            padding: 20px;
-                            background-color: #f5f5f5;
-                        }}
-                        .header {{
-                            background: linear-gradient(135deg, #f093fb 0%, #f5576c 100%);
-                            color: white;
-                            padding: 30px;
-                            border-radius: 10px;
-                            margin-bottom: 30px;
-                            box-shadow: 0 4px 6px rgba(0,0,0,0.1);
-                        }}
-                        h1 {{
-                            margin: 0 0 10px 0;
-                            font-size: 28px;
-                        }}
-                        .info {{
-                            font-size: 16px;
-                            opacity: 0.9;
-                        }}
-                        .coords {{
-                            display: inline-block;
-                            background-color: rgba(255,255,255,0.2);
-                            padding: 5px 10px;
-                            border-radius: 5px;
-                            margin: 5px;
-                        }}
-                        table {{
-                            width: 100%;
-                            border-collapse: collapse;
-                            background-color: white;
-                            box-shadow: 0 2px 4px rgba(0,0,0,0.1);
-                            border-radius: 8px;
-                            overflow: hidden;
-                        }}
-                        th {{
-                            background-color: #f5576c;
-                            color: white;
-                            padding: 15px;
-                            text-align: left;
-                            font-weight: 600;
-                        }}
-                        td {{
-                            padding: 12px 15px;
-                            border-bottom: 1px solid #e0e0e0;
-                        }}
-                        tr:hover {{
-                            background-color: #fff5f7;
-                        }}
-                        tr:last-child td {{
-                            border-bottom: none;
-                        }}
-                        .count-badge {{
-                            display: inline-block;
-                            background-color: #f093fb;
-                            color: white;
-                            padding: 5px 15px;
-                            border-radius: 20px;
-                            font-size: 14px;
-                            margin-top: 10px;
-                        }}
-                        .distance {{
-                            font-weight: bold;
-                            color: #f5576c;
-                        }}
-                    </style>
-                </head>
-                <body>
-                    <div class="header">
-                        <h1>📍 Functional Dissociation by MNI Coordinates</h1>
-                        <div class="info">
-                            <strong>Coordinates A:</strong> 
-                            <span class="coords">[{x1}, {y1}, {z1}]</span><br>
-                            <strong>Coordinates B:</strong> 
-                            <span class="coords">[{x2}, {y2}, {z2}]</span><br>
-                            <strong>Description:</strong> Studies at [{x1}, {y1}, {z1}] but NOT at [{x2}, {y2}, {z2}]
-                        </div>
-                        <div class="count-badge">Total Results: {len(studies)}</div>
-                    </div>
-                    <table>
-                        <thead>
-                            <tr>
-                                <th>#</th>
-                                <th>Study ID</th>
-                                <th>X</th>
-                                <th>Y</th>
-                                <th>Z</th>
-                                <th>Distance from A (mm)</th>
-                            </tr>
-                        </thead>
-                        <tbody>
-                """
-                
-                for idx, study in enumerate(studies, 1):
-                    html += f"""
-                            <tr>
-                                <td>{idx}</td>
-                                <td>{study['study_id']}</td>
-                                <td>{study['x']:.1f}</td>
-                                <td>{study['y']:.1f}</td>
-                                <td>{study['z']:.1f}</td>
-                                <td class="distance">{study['dist_a']:.2f}</td>
-                            </tr>
-                    """
-                
-                html += """
-                        </tbody>
-                    </table>
-                </body>
-                </html>
-                """
+                studies = _rows_as_dicts(conn.execute(_Q_DISSOCIATE_LOCATIONS, {"x1": x1, "y1": y1, "z1": z1, "x2": x2, "y2": y2, "z2": z2}))
                 
-                return html, 200
+                return app.response_class(stream_template(
+                    "dissociate_locations.html",
+                    a={"x": x1, "y": y1, "z": z1},
+                    b={"x": x2, "y": y2, "z": z2},
+                    studies=studies,
+                ))
                 
         except Exception as e:
-            return f"<h1>Error</h1><p>{str(e)}</p>", 500
+            return f"<h1>Error</h1><p>{escape(str(e))}</p>", 500
 
     @app.get("/test_db", endpoint="test_db")
     
@@ -411,45 +491,39 @@ def create_app():
 
         try:
             with eng.begin() as conn:
-                # Ensure we are in the correct schema
-                conn.execute(text("SET search_path TO ns, public;"))
                 payload["version"] = conn.exec_driver_sql("SELECT version()").scalar()
 
-                # Counts
-                payload["coordinates_count"] = conn.execute(text("SELECT COUNT(*) FROM ns.coordinates")).scalar()
-                payload["metadata_count"] = conn.execute(text("SELECT COUNT(*) FROM ns.metadata")).scalar()
-                payload["annotations_terms_count"] = conn.execute(text("SELECT COUNT(*) FROM ns.annotations_terms")).scalar()
+                # Counts (estimated; exact for never-analyzed or empty tables)
+                estimates = dict(conn.execute(_Q_COUNT_ESTIMATES).fetchall())
+                for table, count_sql in _Q_COUNT.items():
+                    n = estimates.get(table, -1)
+                    if n <= 0:
+                        n = conn.execute(count_sql).scalar()
+                    payload[f"{table}_count"] = n
 
                 # Samples
                 try:
-                    rows = conn.execute(text(
-                        "SELECT study_id, ST_X(geom) AS x, ST_Y(geom) AS y, ST_Z(geom) AS z FROM ns.coordinates LIMIT 3"
-                    )).mappings().all()
-                    payload["coordinates_sample"] = [dict(r) for r in rows]
+                    payload["coordinates_sample"] = _rows_as_dicts(conn.execute(_Q_SAMPLE_COORDINATES))
                 except Exception:
                     payload["coordinates_sample"] = []
 
                 try:
                     # Select a few columns if they exist; otherwise select a generic subset
-                    rows = conn.execute(text("SELECT * FROM ns.metadata LIMIT 3")).mappings().all()
-                    payload["metadata_sample"] = [dict(r) for r in rows]
+                    payload["metadata_sample"] = _rows_as_dicts(conn.execute(_Q_SAMPLE_METADATA))
                 except Exception:
                     payload["metadata_sample"] = []
 
                 try:
-                    rows = conn.execute(text(
-                        "SELECT study_id, contrast_id, term, weight FROM ns.annotations_terms LIMIT 3"
-                    )).mappings().all()
-                    payload["annotations_terms_sample"] = [dict(r) for r in rows]
+                    payload["annotations_terms_sample"] = _rows_as_dicts(conn.execute(_Q_SAMPLE_ANNOTATIONS))
                 except Exception:
                     payload["annotations_terms_sample"] = []
 
             payload["ok"] = True
-            return jsonify(payload), 200
+            return ojsonify(payload)
 
         except Exception as e:
             payload["error"] = str(e)
-            return jsonify(payload), 500
+            return ojsonify(payload, 500)
 
     return app
 
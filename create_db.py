@@ -3,7 +3,7 @@
 
 """
 PostgreSQL loader (accelerated) with:
-- PostGIS POINTZ geometry (+ GIST) for coordinates
+- PostGIS POINTZ geometry (+ N-D GIST) for coordinates
 - FTS (tsvector) + trigger (+ GIN) for metadata
 - Fast annotations_terms via NumPy + COPY
 - Optional annotations_json aggregation (+ GIN) via --enable-json
@@ -35,7 +35,7 @@ def parse_args():
     ap.add_argument("--batch-cols", type=int, default=150, help="terms_* columns to melt per batch (smaller uses less RAM)")
     ap.add_argument("--stage-chunksize", type=int, default=50000, help="pandas.to_sql() chunksize for staging loads")
     ap.add_argument("--enable-json", action="store_true", help="Also build annotations_json (slow)")
-    ap.add_argument("--srid", type=int, default=4326, help="SRID for geometry(POINTZ). Default 4326")
+    ap.add_argument("--srid", type=int, default=0, help="SRID for geometry(POINTZ). Default 0 (Cartesian; MNI coordinates are mm, not degrees)")
     return ap.parse_args()
 
 
@@ -120,10 +120,11 @@ def build_coordinates(engine: Engine, df: pd.DataFrame, schema: str, chunksize:
         """))
         print("→ coordinates: indexing & analyze")
         conn.execute(text(f"CREATE INDEX IF NOT EXISTS idx_coordinates_study ON {schema}.coordinates (study_id);"))
-        conn.execute(text(f"CREATE INDEX IF NOT EXISTS idx_coordinates_geom_gist ON {schema}.coordinates USING GIST (geom);"))
+        # N-D opclass so the index serves 3D predicates (ST_3DDWithin), not just X/Y
+        conn.execute(text(f"CREATE INDEX IF NOT EXISTS idx_coordinates_geom_nd ON {schema}.coordinates USING GIST (geom gist_geometry_ops_nd);"))
         conn.execute(text(f"ANALYZE {schema}.coordinates;"))
         conn.execute(text(f"DROP TABLE IF EXISTS {schema}.coordinates_stage;"))
-    print("→ coordinates (POINTZ + GIST) done.")
+    print("→ coordinates (POINTZ + N-D GIST) done.")
 
 
 # -----------------------------
@@ -248,7 +249,8 @@ def build_annotations(engine: Engine, df: pd.DataFrame, schema: str, batch_cols:
             if not mask.any():
                 continue
             idx = np.nonzero(mask)[0]
-            term = re.sub(r"^terms_[^_]*__", "", str(c)).strip().lower()
+            # "terms_abstract_tfidf__posterior cingulate" -> "posterior cingulate"
+            term = str(c).split("__", 1)[-1].strip().lower()
             term_rows.extend(zip(sid_arr[idx], cid_arr[idx], [term]*len(idx), col[idx].astype(float)))
 
         if term_rows:
@@ -261,11 +263,27 @@ def build_annotations(engine: Engine, df: pd.DataFrame, schema: str, batch_cols:
         conn.execute(text(f"CREATE INDEX IF NOT EXISTS idx_annotations_terms_term ON {schema}.annotations_terms (term);"))
         conn.execute(text(f"CREATE INDEX IF NOT EXISTS idx_annotations_terms_study ON {schema}.annotations_terms (study_id);"))
         conn.execute(text(f"CREATE INDEX IF NOT EXISTS idx_annotations_terms_term_study ON {schema}.annotations_terms (term, study_id);"))
+        # Trigram GIN so substring matches (term ILIKE '%foo%') can use a bitmap index scan
+        conn.execute(text(f"CREATE INDEX IF NOT EXISTS idx_annotations_terms_term_trgm ON {schema}.annotations_terms USING GIN (term gin_trgm_ops);"))
         conn.execute(text(f"ANALYZE {schema}.annotations_terms;"))
         # Build PK/unique AFTER load to avoid per-row maintenance
         conn.execute(text(f"CREATE UNIQUE INDEX IF NOT EXISTS ux_annotations_terms ON {schema}.annotations_terms (study_id, contrast_id, term);"))
         conn.execute(text(f"ALTER TABLE {schema}.annotations_terms ADD CONSTRAINT pk_annotations_terms PRIMARY KEY USING INDEX ux_annotations_terms;"))
 
+        # Pre-aggregated (study, term) -> avg weight for /terms/<term>/studies.
+        # Dropped by the CASCADE above on reload, so it is rebuilt here each time.
+        print("→ term_study_weights: materializing per-study term weights")
+        conn.execute(text(f"""
+            CREATE MATERIALIZED VIEW IF NOT EXISTS {schema}.term_study_weights AS
+            SELECT study_id, term, AVG(weight) AS avg_weight
+            FROM {schema}.annotations_terms
+            GROUP BY study_id, term;
+        """))
+        # Unique index also allows REFRESH MATERIALIZED VIEW CONCURRENTLY
+        conn.execute(text(f"CREATE UNIQUE INDEX IF NOT EXISTS ux_term_study_weights ON {schema}.term_study_weights (study_id, term);"))
+        conn.execute(text(f"CREATE INDEX IF NOT EXISTS idx_term_study_weights_term_trgm ON {schema}.term_study_weights USING GIN (term gin_trgm_ops);"))
+        conn.execute(text(f"ANALYZE {schema}.term_study_weights;"))
+
         if enable_json:
             print("→ annotations_json: aggregating (this may take a while)")
             conn.execute(text("SET LOCAL work_mem = '512MB';"))
@@ -324,9 +342,10 @@ def main():
     build_annotations(engine, ann, args.schema, args.batch_cols, enable_json=args.enable_json)
 
     print("\n=== Ready ===")
-    print(f"- coordinates  : {args.schema}.coordinates (geometry(POINTZ,{args.srid}) + GIST)")
+    print(f"- coordinates  : {args.schema}.coordinates (geometry(POINTZ,{args.srid}) + N-D GIST)")
     print(f"- metadata     : {args.schema}.metadata (FTS + trigger + GIN)")
     print(f"- annotations  : {args.schema}.annotations_terms (sparse via COPY)" + (" + annotations_json (GIN)" if args.enable_json else ""))
+    print(f"- term weights : {args.schema}.term_study_weights (materialized view + trigram GIN)")
 
 
 if __name__ == "__main__":
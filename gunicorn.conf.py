@@ -0,0 +1,17 @@
+# gunicorn.conf.py
+# Picked up automatically by `gunicorn app:app`.
+import multiprocessing
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', '8000')}"
+
+# Threaded workers: psycopg2 releases the GIL while waiting on PostgreSQL,
+# so concurrent requests overlap their DB round-trips instead of queueing
+# behind the worker count.
+worker_class = "gthread"
+workers = int(os.getenv("WEB_CONCURRENCY", min(multiprocessing.cpu_count() * 2 + 1, 4)))
+threads = int(os.getenv("GUNICORN_THREADS", "8"))
+
+# Each worker builds exactly one engine after fork (get_engine is lazy and
+# lock-guarded against its own threads), so no pool is shared across processes.
+preload_app = False